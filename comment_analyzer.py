@@ -1,11 +1,26 @@
+import asyncio
+import hashlib
+import heapq
+import itertools
 import json
 import os
-import time
+import random
 import argparse
+from collections import Counter
+from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
+from google.api_core import exceptions as google_exceptions
 import google.generativeai as genai
 from google.generativeai import types
 import logging
+import threading
+import ahocorasick
+import fastjsonschema
+import ijson
+import orjson
+import matplotlib
+
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 from better_profanity import profanity
 
@@ -18,30 +33,320 @@ logging.basicConfig(
 load_dotenv()
 
 
+class InvalidAnalysisError(ValueError):
+    """Raised when the model returns an incomplete or invalid analysis."""
+
+
 INPUT_FILE = "comments.json"
 OUTPUT_FILE = "analyzed_comments.json"
+CHECKPOINT_FILE = "analyzed_comments.jsonl"
+CHECKPOINT_INTERVAL = 500
+# Caches are rewritten whole, so they are flushed every this many
+# checkpointed chunks (and at exit) rather than after each one.
+CACHE_FLUSH_INTERVAL = 10
+CACHE_FILE = "cache.json"
+SEMANTIC_CACHE_FILE = "semantic_cache.npz"
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+SEMANTIC_SIMILARITY_THRESHOLD = 0.92
+BENIGN_TOXICITY_THRESHOLD = 0.05
+LOCAL_MODEL_BATCH_SIZE = 64
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 MODEL_NAME = "gemini-1.5-flash"
+# All requests are async, so a single grpc.aio channel (one multiplexed
+# HTTP/2 connection) is shared by every call in the run.
+GEMINI_TRANSPORT = "grpc_asyncio"
 MAX_RETRIES = 3
 RETRY_DELAY = 5
+MAX_RETRY_DELAY = 60
+RETRYABLE_EXCEPTIONS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    # Incomplete model output, which a new attempt may fix.
+    InvalidAnalysisError,
+)
+MAX_CONCURRENCY = 32
+GEMINI_QPS = os.environ.get("GEMINI_QPS")
+DEFAULT_GEMINI_QPS = 10
+BATCH_SIZE = 20
+TOKEN_BUDGET = 6000
+CHARS_PER_TOKEN = 4
+GENERATION_CONFIG = types.GenerationConfig(response_mime_type="application/json")
+# Offense types of the placeholder analyses used when the model gives no answer.
+FALLBACK_OFFENSE_TYPES = {"blocked/unclear", "blocked", "stopped"}
+ANALYSIS_FIELDS = ["is_offensive", "offense_type", "explanation", "severity"]
+validate_analysis = fastjsonschema.compile(
+    {
+        "type": "object",
+        "required": ANALYSIS_FIELDS,
+        "properties": {
+            "is_offensive": {"type": "boolean"},
+            "offense_type": {"type": "string"},
+            "explanation": {"type": "string"},
+            "severity": {"type": "integer", "minimum": 0, "maximum": 5},
+        },
+    }
+)
+
+# Sent once per model as the system instruction, so the shared preamble is an
+# identical prefix on every request and only the comments vary.
+SYSTEM_INSTRUCTION = """
+Analyze user comments and determine if they are offensive.
+Provide your analysis of each comment as a JSON object with the following fields:
+- "is_offensive": boolean (true if offensive, false otherwise)
+- "offense_type": string (e.g., "hate speech", "toxicity", "profanity", "harassment", "spam", "none")
+- "explanation": string (a brief explanation for the classification)
+- "severity": integer (estimated severity from 1-5, 5 being most severe; 0 if not offensive)
+"""
+PROMPT_TEMPLATE = """
+Analyze the following user comment and respond with a single JSON object.
+
+Comment: "{comment_text}"
+
+JSON Response:
+"""
+BATCH_PROMPT_TEMPLATE = """
+Analyze each of the following numbered user comments and respond with a JSON array
+containing one object per comment. Each object must also have an "id" field:
+integer (the number of the comment).
+
+Comments:
+{numbered_comments}
+
+JSON Response:
+"""
 
 
 def load_comments(filepath):
-    """Loads comments from a JSON file."""
+    """Streams comments from a JSON file without loading it all into memory.
+
+    Returns a generator of comments, or None if the file cannot be opened.
+    """
     try:
-        with open(filepath, "r", encoding="utf-8") as f:
-            comments = json.load(f)
-        logging.info(f"Successfully loaded {len(comments)} comments from {filepath}")
-        return comments
+        f = open(filepath, "rb")
     except FileNotFoundError:
         logging.error(f"Error: Input file not found at {filepath}")
         return None
-    except json.JSONDecodeError:
-        logging.error(f"Error: Could not decode JSON from {filepath}")
-        return None
     except Exception as e:
         logging.error(f"An unexpected error occurred while loading comments: {e}")
         return None
+    logging.info(f"Streaming comments from {filepath}")
+    return _iter_comments(f, filepath)
+
+
+def _iter_comments(f, filepath):
+    """Yields the items of the top-level JSON array in an open file."""
+    with f:
+        yield from ijson.items(f, "item", use_float=True)
+
+
+def load_cache(filepath):
+    """Loads the response cache from a JSON file, or starts an empty one."""
+    try:
+        with open(filepath, "rb") as f:
+            cache = orjson.loads(f.read())
+        logging.info(f"Loaded {len(cache)} cached analyses from {filepath}")
+        return cache
+    except FileNotFoundError:
+        return {}
+    except (orjson.JSONDecodeError, IOError) as e:
+        logging.warning(f"Ignoring unreadable cache file {filepath}: {e}")
+        return {}
+
+
+def save_cache(filepath, cache):
+    """Atomically writes the response cache to a JSON file."""
+    tmp_filepath = f"{filepath}.tmp"
+    try:
+        with open(tmp_filepath, "wb") as f:
+            f.write(orjson.dumps(cache))
+        os.replace(tmp_filepath, filepath)
+        logging.info(f"Saved {len(cache)} cached analyses to {filepath}")
+    except IOError as e:
+        logging.error(f"Error writing cache to {filepath}: {e}")
+
+
+def cache_key(comment_text):
+    """Returns the cache key for a comment: a SHA-256 of its normalized text."""
+    return hashlib.sha256(comment_text.strip().lower().encode("utf-8")).hexdigest()
+
+
+def text_digest(comment_text):
+    """Returns a compact identifier of a comment's exact text."""
+    return hashlib.sha256(comment_text.encode("utf-8")).digest()
+
+
+class SemanticCache:
+    """Reuses analyses of previously seen comments with a similar meaning.
+
+    Comments are embedded with a local sentence-transformers model; a new
+    comment whose cosine similarity to a stored one exceeds the threshold
+    reuses the stored analysis instead of calling the API.
+    """
+
+    def __init__(self, filepath, threshold=SEMANTIC_SIMILARITY_THRESHOLD):
+        import numpy as np
+        from sentence_transformers import SentenceTransformer
+
+        self._np = np
+        self.filepath = filepath
+        self.threshold = threshold
+        self.encoder = SentenceTransformer(EMBEDDING_MODEL_NAME)
+        self.embeddings = np.empty(
+            (0, self.encoder.get_sentence_embedding_dimension()), dtype=np.float32
+        )
+        self.analyses = []
+
+        try:
+            with np.load(filepath) as data:
+                self.embeddings = data["embeddings"]
+                self.analyses = json.loads(str(data["analyses"]))
+            logging.info(
+                f"Loaded {len(self.analyses)} semantic cache entries from {filepath}"
+            )
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, IOError) as e:
+            logging.warning(f"Ignoring unreadable semantic cache {filepath}: {e}")
+
+    def encode(self, comment_texts):
+        """Returns L2-normalized embeddings, so inner product is cosine similarity."""
+        if not comment_texts:
+            return self.embeddings[:0]
+        return self.encoder.encode(
+            comment_texts, normalize_embeddings=True, convert_to_numpy=True
+        ).astype(self._np.float32)
+
+    def lookup(self, embeddings):
+        """Returns the stored analysis for each embedding, or None on a miss."""
+        if not self.analyses or len(embeddings) == 0:
+            return [None] * len(embeddings)
+        similarities = embeddings @ self.embeddings.T
+        best = similarities.argmax(axis=1)
+        return [
+            self.analyses[j] if similarities[i, j] > self.threshold else None
+            for i, j in enumerate(best)
+        ]
+
+    def add(self, embeddings, analyses):
+        """Stores new embedding/analysis pairs."""
+        if not analyses:
+            return
+        self.embeddings = self._np.vstack([self.embeddings, embeddings])
+        self.analyses.extend(analyses)
+
+    def save(self):
+        """Atomically writes the embeddings and analyses to disk."""
+        tmp_filepath = f"{self.filepath}.tmp.npz"
+        try:
+            self._np.savez(
+                tmp_filepath,
+                embeddings=self.embeddings,
+                analyses=self._np.array(json.dumps(self.analyses, ensure_ascii=False)),
+            )
+            os.replace(tmp_filepath, self.filepath)
+            logging.info(
+                f"Saved {len(self.analyses)} semantic cache entries to {self.filepath}"
+            )
+        except IOError as e:
+            logging.error(f"Error writing semantic cache to {self.filepath}: {e}")
+
+
+class LocalToxicityClassifier:
+    """Scores comment toxicity with a small local ONNX model.
+
+    Expects a directory holding `model.onnx` and `tokenizer.json`, e.g. a
+    multi-label toxicity classifier such as unitary/toxic-bert exported with
+    Hugging Face Optimum. The toxicity score is the highest label probability.
+    """
+
+    def __init__(self, model_dir):
+        import numpy as np
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        self._np = np
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, "model.onnx")
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_padding()
+        self.tokenizer.enable_truncation(max_length=512)
+        logging.info(f"Loaded local toxicity model from {model_dir}")
+
+    def toxicity_scores(self, comment_texts):
+        """Returns the probability that each comment is toxic."""
+        scores = []
+        for start in range(0, len(comment_texts), LOCAL_MODEL_BATCH_SIZE):
+            encodings = self.tokenizer.encode_batch(
+                comment_texts[start : start + LOCAL_MODEL_BATCH_SIZE]
+            )
+            inputs = {
+                "input_ids": [e.ids for e in encodings],
+                "attention_mask": [e.attention_mask for e in encodings],
+                "token_type_ids": [e.type_ids for e in encodings],
+            }
+            inputs = {
+                name: self._np.array(values, dtype=self._np.int64)
+                for name, values in inputs.items()
+                if name in self.input_names
+            }
+            logits = self.session.run(None, inputs)[0]
+            probabilities = 1 / (1 + self._np.exp(-logits))
+            scores.extend(probabilities.max(axis=1).tolist())
+        return scores
+
+
+def build_profanity_automaton():
+    """Builds an Aho-Corasick automaton over the better-profanity word list.
+
+    Each word is added with every substitution better-profanity also
+    recognizes (e.g. "sh1t", "$hit", "@ss"), so a comment is scanned in a
+    single pass. Separators inside a word (e.g. "blow job") are dropped,
+    since contains_profanity() joins the words of a comment.
+    """
+    profanity.load_censor_words()
+    automaton = ahocorasick.Automaton()
+    for word in profanity.CENSOR_WORDSET:
+        word = str(word)
+        for spelling in itertools.product(
+            *(
+                profanity.CHARS_MAPPING.get(char, (char,))
+                for char in word
+                if char in profanity.ALLOWED_CHARACTERS
+            )
+        ):
+            spelling = "".join(spelling)
+            automaton.add_word(spelling, spelling)
+    automaton.make_automaton()
+    return automaton
+
+
+def contains_profanity(automaton, text):
+    """Checks whether a text contains a profane word, as better-profanity would.
+
+    Words are split on the characters better-profanity treats as separators
+    and joined, so words split by separators (e.g. "butt_hole") are found too.
+    A match must start and end on word boundaries, and is then confirmed with
+    better-profanity itself, so clean comments never pay for its slow scan.
+    """
+    words = (
+        "".join(char if char in profanity.ALLOWED_CHARACTERS else " " for char in text)
+        .lower()
+        .split()
+    )
+    starts, ends = set(), set()
+    offset = 0
+    for word in words:
+        starts.add(offset)
+        offset += len(word)
+        ends.add(offset - 1)
+    for end, word in automaton.iter("".join(words)):
+        if end - len(word) + 1 in starts and end in ends:
+            return profanity.contains_profanity(text)
+    return False
 
 
 def configure_genai():
@@ -51,7 +356,7 @@ def configure_genai():
         logging.info("Please create a .env file with GEMINI_API_KEY=YOUR_API_KEY_HERE")
         return None
     try:
-        genai.configure(api_key=GEMINI_API_KEY)
+        genai.configure(api_key=GEMINI_API_KEY, transport=GEMINI_TRANSPORT)
 
         logging.info("Google GenAI client configured successfully.")
         return genai
@@ -60,29 +365,81 @@ def configure_genai():
         return None
 
 
-def analyze_comment_with_retry(client, model_name, comment_text):
-    """Analyzes a single comment using the Gemini API with retry logic."""
-    prompt = f"""
-    Analyze the following user comment and determine if it is offensive.
-    Provide your analysis in JSON format with the following fields:
-    - "is_offensive": boolean (true if offensive, false otherwise)
-    - "offense_type": string (e.g., "hate speech", "toxicity", "profanity", "harassment", "spam", "none")
-    - "explanation": string (a brief explanation for the classification)
-    - "severity": integer (estimated severity from 1-5, 5 being most severe; 0 if not offensive)
+def parse_qps(value):
+    """Parses the GEMINI_QPS setting into a request rate.
+
+    Falls back to the default when the setting is unset or blank, and with a
+    warning when it is not a positive number.
+    """
+    if value is None or not value.strip():
+        return DEFAULT_GEMINI_QPS
+    try:
+        qps = float(value)
+    except ValueError:
+        qps = None
+    if qps is None or not 0 < qps < float("inf"):
+        logging.warning(
+            f"Invalid GEMINI_QPS value {value!r}; using the default of {DEFAULT_GEMINI_QPS} requests per second."
+        )
+        return DEFAULT_GEMINI_QPS
+    return qps
+
+
+def backoff_delay(attempt):
+    """Returns a jittered exponential backoff delay for a retry attempt."""
+    return random.uniform(0, min(MAX_RETRY_DELAY, RETRY_DELAY * 2**attempt))
+
+
+def is_cacheable_analysis(analysis):
+    """Checks whether an analysis came from the model and can be reused.
+
+    Placeholder classifications for blocked, stopped or empty responses may be
+    transient, so they are not cached and the comment is re-queried next run.
+    """
+    return (
+        bool(analysis)
+        and "error" not in analysis
+        and analysis.get("offense_type") not in FALLBACK_OFFENSE_TYPES
+    )
+
+
+def is_valid_analysis(analysis):
+    """Checks that an analysis returned by the model matches the expected schema."""
+    try:
+        validate_analysis(analysis)
+        return True
+    except fastjsonschema.JsonSchemaException:
+        return False
+
 
-    Comment: "{comment_text}"
+async def analyze_comment_async(model, comment_text, semaphore, limiter, cache):
+    """Analyzes a single comment using the Gemini API with retry logic.
 
-    JSON Response:
+    The semaphore bounds how many requests are in flight at once and the
+    limiter caps the request rate. Results are looked up in and stored to
+    `cache`, so repeated comments skip the API.
     """
+    key = cache_key(comment_text)
+    if key in cache:
+        logging.debug(f"Cache hit for comment: '{comment_text[:50]}...'")
+        return cache[key]
+
+    analysis = await _request_analysis(model, comment_text, semaphore, limiter)
+    if is_cacheable_analysis(analysis):
+        cache[key] = analysis
+    return analysis
 
-    model = client.GenerativeModel(model_name)
-    generation_config = types.GenerationConfig(response_mime_type="application/json")
+
+async def _request_analysis(model, comment_text, semaphore, limiter):
+    """Requests an analysis of a single comment from the Gemini API."""
+    prompt = PROMPT_TEMPLATE.format(comment_text=comment_text)
 
     for attempt in range(MAX_RETRIES):
         try:
-            response = model.generate_content(
-                prompt, generation_config=generation_config
-            )
+            async with semaphore, limiter:
+                response = await model.generate_content_async(
+                    prompt, generation_config=GENERATION_CONFIG
+                )
 
             if not response.parts:
                 logging.warning(
@@ -96,16 +453,13 @@ def analyze_comment_with_retry(client, model_name, comment_text):
                     "severity": 3,
                 }
 
-            analysis_json = json.loads(response.text)
+            analysis_json = orjson.loads(response.text)
 
-            if not all(
-                k in analysis_json
-                for k in ["is_offensive", "offense_type", "explanation", "severity"]
-            ):
+            if not is_valid_analysis(analysis_json):
                 logging.warning(
-                    f"Received incomplete JSON from API for comment: '{comment_text[:50]}...'. Retrying..."
+                    f"Received incomplete or invalid JSON from API for comment: '{comment_text[:50]}...'. Retrying..."
                 )
-                raise ValueError("Incomplete JSON structure")
+                raise InvalidAnalysisError("Incomplete JSON structure")
 
             logging.debug(f"Successfully analyzed comment: '{comment_text[:50]}...'")
             return analysis_json
@@ -130,7 +484,7 @@ def analyze_comment_with_retry(client, model_name, comment_text):
                 "explanation": f"Content generation stopped, potentially due to policy violation. Reason: {sce}",
                 "severity": 3,
             }
-        except json.JSONDecodeError as jde:
+        except orjson.JSONDecodeError as jde:
             logging.warning(
                 f"Failed to decode JSON response from API for comment: '{comment_text[:50]}...'. Response text: {response.text}. Error: {jde}. Attempt {attempt + 1}/{MAX_RETRIES}"
             )
@@ -139,8 +493,13 @@ def analyze_comment_with_retry(client, model_name, comment_text):
                     f"Failed to get valid JSON after {MAX_RETRIES} attempts for comment: '{comment_text[:50]}...'"
                 )
                 return None
-            time.sleep(RETRY_DELAY)
+            await asyncio.sleep(backoff_delay(attempt))
         except Exception as e:
+            if not isinstance(e, RETRYABLE_EXCEPTIONS):
+                logging.error(
+                    f"Non-retryable error analyzing comment '{comment_text[:50]}...': {e}"
+                )
+                return None
             logging.warning(
                 f"Error analyzing comment '{comment_text[:50]}...': {e}. Attempt {attempt + 1}/{MAX_RETRIES}"
             )
@@ -149,15 +508,172 @@ def analyze_comment_with_retry(client, model_name, comment_text):
                     f"Failed to analyze comment after {MAX_RETRIES} attempts: '{comment_text[:50]}...'"
                 )
                 return None
-            time.sleep(RETRY_DELAY)
+            await asyncio.sleep(backoff_delay(attempt))
     return None
 
 
+async def analyze_comments_batch(model, batch, semaphore, limiter):
+    """Analyzes several comments with a single Gemini API call.
+
+    Returns a list aligned with `batch` holding each comment's analysis, or
+    None for comments missing or malformed in the response. API errors that
+    persist after retries (or are not retryable) are raised, so the caller
+    does not retry each comment of the batch separately.
+    """
+    numbered_comments = "\n".join(
+        f"{i}. {json.dumps(comment_text, ensure_ascii=False)}"
+        for i, comment_text in enumerate(batch, start=1)
+    )
+    prompt = BATCH_PROMPT_TEMPLATE.format(numbered_comments=numbered_comments)
+
+    for attempt in range(MAX_RETRIES):
+        try:
+            async with semaphore, limiter:
+                response = await model.generate_content_async(
+                    prompt, generation_config=GENERATION_CONFIG
+                )
+            break
+        except (
+            types.generation_types.BlockedPromptException,
+            types.generation_types.StopCandidateException,
+        ) as e:
+            logging.warning(
+                f"Batch of {len(batch)} comments could not be analyzed together: {e}"
+            )
+            return [None] * len(batch)
+        except Exception as e:
+            if not isinstance(e, RETRYABLE_EXCEPTIONS):
+                raise
+            logging.warning(
+                f"Error analyzing batch of {len(batch)} comments: {e}. Attempt {attempt + 1}/{MAX_RETRIES}"
+            )
+            if attempt + 1 == MAX_RETRIES:
+                raise
+            await asyncio.sleep(backoff_delay(attempt))
+
+    try:
+        analyses = orjson.loads(response.text)
+    except ValueError as e:
+        # response.text raises ValueError for an empty or blocked response, and
+        # orjson.JSONDecodeError (a ValueError) covers invalid JSON.
+        logging.warning(
+            f"Batch of {len(batch)} comments could not be analyzed together: {e}"
+        )
+        return [None] * len(batch)
+
+    results = [None] * len(batch)
+    if not isinstance(analyses, list):
+        logging.warning("Batch response was not a JSON array.")
+        return results
+
+    for analysis in analyses:
+        if not is_valid_analysis(analysis):
+            continue
+        index = analysis.pop("id", None)
+        if isinstance(index, int) and 1 <= index <= len(batch):
+            results[index - 1] = analysis
+    return results
+
+
+def estimate_tokens(text):
+    """Roughly estimates the number of tokens in a text."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def build_batches(comment_texts, indices, batch_size, token_budget=TOKEN_BUDGET):
+    """Groups comment indices into batches of comments with similar lengths.
+
+    Comments are sorted by length and packed greedily, so each batch holds at
+    most `batch_size` comments and about `token_budget` tokens of comment text.
+    """
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for i in sorted(indices, key=lambda i: len(comment_texts[i])):
+        tokens = estimate_tokens(comment_texts[i])
+        if batch and (len(batch) == batch_size or batch_tokens + tokens > token_budget):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+async def analyze_comments_concurrently(
+    model, comment_texts, max_concurrency, limiter, cache, batch_size
+):
+    """Analyzes many comments concurrently, keeping results in input order.
+
+    Comments are grouped by length and sent up to `batch_size` at a
+    time in a single prompt. Comments missing or malformed in a batch response
+    are retried one by one; comments of a batch that failed with an API error
+    are left as failed (None).
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    results = [None] * len(comment_texts)
+
+    batches = build_batches(comment_texts, range(len(comment_texts)), batch_size)
+    batch_results = await asyncio.gather(
+        *(
+            analyze_comments_batch(
+                model, [comment_texts[i] for i in batch], semaphore, limiter
+            )
+            for batch in batches
+        ),
+        return_exceptions=True,
+    )
+
+    fallback = []
+    for batch, analyses in zip(batches, batch_results):
+        if isinstance(analyses, Exception):
+            logging.error(
+                f"Failed to analyze batch of {len(batch)} comments: {analyses}"
+            )
+            continue
+        for i, analysis in zip(batch, analyses):
+            if analysis:
+                results[i] = analysis
+                if is_cacheable_analysis(analysis):
+                    cache[cache_key(comment_texts[i])] = analysis
+            else:
+                fallback.append(i)
+
+    if fallback:
+        logging.info(f"Retrying {len(fallback)} comments individually...")
+        fallback_results = await asyncio.gather(
+            *(
+                analyze_comment_async(
+                    model, comment_texts[i], semaphore, limiter, cache
+                )
+                for i in fallback
+            ),
+            return_exceptions=True,
+        )
+        for i, analysis in zip(fallback, fallback_results):
+            results[i] = analysis
+
+    return results
+
+
 def save_analyzed_comments(filepath, data):
-    """Saves the analyzed comments to a JSON file."""
+    """Saves the analyzed comments to a JSON file.
+
+    Records are encoded and written one at a time, so the whole file is
+    never held in memory as a single string.
+    """
     try:
-        with open(filepath, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
+        with open(filepath, "wb") as f:
+            f.write(b"[")
+            for i, record in enumerate(data):
+                encoded = orjson.dumps(
+                    record, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+                )
+                f.write(b",\n  " if i else b"\n  ")
+                f.write(encoded.replace(b"\n", b"\n  "))
+            f.write(b"\n]\n")
         logging.info(f"Successfully saved analyzed comments to {filepath}")
     except IOError as e:
         logging.error(f"Error writing analyzed comments to {filepath}: {e}")
@@ -165,11 +681,127 @@ def save_analyzed_comments(filepath, data):
         logging.error(f"An unexpected error occurred while saving comments: {e}")
 
 
+def record_hash(comment):
+    """Returns a stable hash of an input comment record."""
+    return hashlib.sha256(
+        orjson.dumps(comment, option=orjson.OPT_SORT_KEYS)
+    ).hexdigest()
+
+
+def read_checkpoint(filepath):
+    """Yields (input position, input record hash, comment) entries from the
+    JSONL checkpoint file.
+
+    Comment IDs may be missing or repeated, so entries are identified by the
+    comment's position in the input file. A partially written last line is
+    ignored.
+    """
+    try:
+        f = open(filepath, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        for line in f:
+            try:
+                entry = orjson.loads(line)
+                index, comment_hash = entry["index"], entry["record_hash"]
+                comment = entry["comment"]
+            except (orjson.JSONDecodeError, KeyError, TypeError):
+                continue
+            yield index, comment_hash, comment
+
+
+def load_checkpoint_state(filepath):
+    """Loads which comments previous runs already analyzed.
+
+    Returns a dict mapping input positions to (input record hash, whether
+    the analysis succeeded). Later lines win, so a comment re-analyzed after
+    a failure replaces its earlier entry. Only this is kept in memory, not
+    the analyzed comments themselves.
+    """
+    return {
+        index: (comment_hash, "error" not in comment.get("analysis", {}))
+        for index, comment_hash, comment in read_checkpoint(filepath)
+    }
+
+
+def load_checkpoint(filepath):
+    """Loads analyzed comments from the checkpoint file, keyed by input position."""
+    return {index: comment for index, _, comment in read_checkpoint(filepath)}
+
+
+def is_checkpointed(index, comment_hash, checkpoint_state):
+    """Checks whether the comment at an input position was already analyzed
+    successfully and has not changed since."""
+    return checkpoint_state.get(index) == (comment_hash, True)
+
+
+def open_checkpoint(filepath):
+    """Opens the JSONL checkpoint file for appending analyzed comments."""
+    f = open(filepath, "ab")
+    if f.tell() > 0:
+        with open(filepath, "rb") as existing:
+            existing.seek(-1, os.SEEK_END)
+            if existing.read(1) != b"\n":
+                # Start on a fresh line after a write interrupted by a crash.
+                f.write(b"\n")
+    return f
+
+
+def append_checkpoint(f, entries):
+    """Durably appends analyzed comments to the JSONL checkpoint file.
+
+    Each entry is an (input position, input record hash, comment) tuple.
+    """
+    for index, comment_hash, comment in entries:
+        line = {"index": index, "record_hash": comment_hash, "comment": comment}
+        f.write(orjson.dumps(line) + b"\n")
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def render_chart(offense_counts):
+    """Renders the offense type distribution as a bar chart image."""
+    try:
+        types = list(offense_counts.keys())
+        counts = list(offense_counts.values())
+
+        plt.figure(figsize=(10, 6))
+        bars = plt.bar(types, counts, color="skyblue")
+        plt.xlabel("Offense Type")
+        plt.ylabel("Number of Comments")
+        plt.title("Distribution of Offensive Comment Types")
+        plt.xticks(rotation=45, ha="right")
+        plt.tight_layout()
+
+        for bar in bars:
+            yval = bar.get_height()
+            plt.text(
+                bar.get_x() + bar.get_width() / 2.0,
+                yval,
+                int(yval),
+                va="bottom",
+                ha="center",
+            )
+
+        chart_filename = "offense_distribution.png"
+        plt.savefig(chart_filename)
+        logging.info(f"Saved offense distribution chart to {chart_filename}")
+        plt.close()
+    except Exception as e:
+        logging.error(f"Failed to generate or save offense distribution chart: {e}")
+
+
 def generate_report(analyzed_comments):
-    """Generates and prints a summary report."""
+    """Generates and prints a summary report.
+
+    The chart is rendered on a background thread, which is returned so the
+    caller can wait for it before exiting.
+    """
+    chart_thread = None
     if not analyzed_comments:
         logging.warning("No analyzed comments to generate a report for.")
-        return
+        return chart_thread
 
     offensive_comments = [
         c for c in analyzed_comments if c.get("analysis", {}).get("is_offensive")
@@ -183,21 +815,25 @@ def generate_report(analyzed_comments):
 
     if num_offensive > 0:
         print("\nOffense Type Breakdown:")
-        offense_counts = {}
-        for comment in offensive_comments:
-            offense_type = comment.get("analysis", {}).get("offense_type", "unknown")
-            offense_counts[offense_type] = offense_counts.get(offense_type, 0) + 1
+        offense_counts = Counter(
+            comment.get("analysis", {}).get("offense_type", "unknown")
+            for comment in offensive_comments
+        )
+        chart_thread = threading.Thread(target=render_chart, args=(offense_counts,))
+        chart_thread.start()
 
         for offense_type, count in sorted(offense_counts.items()):
             print(f"- {offense_type.capitalize()}: {count}")
 
         print("\nTop 5 Most Offensive Comments (by estimated severity):")
-        offensive_comments.sort(
-            key=lambda x: x.get("analysis", {}).get("severity", 0), reverse=True
+        top_comments = heapq.nlargest(
+            5,
+            offensive_comments,
+            key=lambda x: x.get("analysis", {}).get("severity", 0),
         )
-        for i, comment in enumerate(offensive_comments[:5]):
+        for i, comment in enumerate(top_comments):
             print(
-                f"{i+1}. ID: {comment['comment_id']}, User: {comment['username']}, Severity: {comment.get('analysis', {}).get('severity', 'N/A')}"
+                f"{i+1}. ID: {comment.get('comment_id')}, User: {comment['username']}, Severity: {comment.get('analysis', {}).get('severity', 'N/A')}"
             )
             print(f"   Comment: {comment['comment_text']}")
             print(
@@ -205,37 +841,236 @@ def generate_report(analyzed_comments):
             )
             print("-" * 10)
 
-    if num_offensive > 0:
-        try:
-            types = list(offense_counts.keys())
-            counts = list(offense_counts.values())
-
-            plt.figure(figsize=(10, 6))
-            bars = plt.bar(types, counts, color="skyblue")
-            plt.xlabel("Offense Type")
-            plt.ylabel("Number of Comments")
-            plt.title("Distribution of Offensive Comment Types")
-            plt.xticks(rotation=45, ha="right")
-            plt.tight_layout()
-
-            for bar in bars:
-                yval = bar.get_height()
-                plt.text(
-                    bar.get_x() + bar.get_width() / 2.0,
-                    yval,
-                    int(yval),
-                    va="bottom",
-                    ha="center",
-                )
+    print("--- End of Report ---")
+    return chart_thread
 
-            chart_filename = "offense_distribution.png"
-            plt.savefig(chart_filename)
-            logging.info(f"Saved offense distribution chart to {chart_filename}")
-            plt.close()
-        except Exception as e:
-            logging.error(f"Failed to generate or save offense distribution chart: {e}")
 
-    print("--- End of Report ---")
+async def analyze_comments(
+    comments,
+    model,
+    profanity_automaton,
+    cache,
+    semantic_cache,
+    local_classifier,
+    concurrency,
+    limiter,
+    batch_size,
+    stats,
+    seen_analyses,
+):
+    """Adds an `analysis` to each comment, counting outcomes in `stats`.
+
+    Comments go through the profanity pre-filter, duplicate collapsing, the
+    response cache, the optional local model and semantic cache, and finally
+    the Gemini API. `seen_analyses` maps a digest of each comment text
+    analyzed earlier in the run to its analysis, so duplicates are collapsed
+    across chunks too; it is updated with this chunk's analyses.
+    """
+    pending_comments = []
+    comments_by_text = {}
+
+    for comment in comments:
+        comment_text = comment.get("comment_text")
+        if not comment_text:
+            logging.warning(
+                f"Skipping comment ID {comment.get('comment_id')} due to missing 'comment_text'."
+            )
+            comment["analysis"] = {"error": "Missing comment text"}
+            stats["failed"] += 1
+            continue
+
+        if contains_profanity(profanity_automaton, comment_text):
+            logging.info(
+                f"Profanity detected in comment ID: {comment.get('comment_id')}. Skipping API call."
+            )
+            comment["analysis"] = {
+                "is_offensive": True,
+                "offense_type": "profanity",
+                "explanation": "Detected by profanity pre-filter.",
+                "severity": 3,
+            }
+            stats["pre_filtered"] += 1
+            continue
+
+        if comment_text in comments_by_text:
+            comments_by_text[comment_text].append(comment)
+            stats["duplicates"] += 1
+            continue
+
+        seen = seen_analyses.get(text_digest(comment_text))
+        if seen:
+            comment["analysis"] = dict(seen)
+            stats["duplicates"] += 1
+            if "error" in seen:
+                stats["failed"] += 1
+            continue
+
+        comments_by_text[comment_text] = [comment]
+        cached = cache.get(cache_key(comment_text))
+        if cached:
+            comment["analysis"] = cached
+            stats["cache_hits"] += 1
+            continue
+
+        pending_comments.append(comment)
+
+    if local_classifier:
+        scores = local_classifier.toxicity_scores(
+            [comment["comment_text"] for comment in pending_comments]
+        )
+        uncertain = []
+        for comment, score in zip(pending_comments, scores):
+            if score < BENIGN_TOXICITY_THRESHOLD:
+                comment["analysis"] = {
+                    "is_offensive": False,
+                    "offense_type": "none",
+                    "explanation": f"Classified as benign by local pre-filter (toxicity score {score:.3f}).",
+                    "severity": 0,
+                }
+                stats["local_filtered"] += 1
+            else:
+                uncertain.append(comment)
+        pending_comments = uncertain
+
+    if semantic_cache:
+        embeddings = semantic_cache.encode(
+            [comment["comment_text"] for comment in pending_comments]
+        )
+        matches = semantic_cache.lookup(embeddings)
+        missed = []
+        for comment, embedding, match in zip(pending_comments, embeddings, matches):
+            if match:
+                comment["analysis"] = match
+                stats["semantic_hits"] += 1
+            else:
+                missed.append((comment, embedding))
+        pending_comments = [comment for comment, _ in missed]
+        pending_embeddings = [embedding for _, embedding in missed]
+
+    logging.info(
+        f"Analyzing {len(pending_comments)} comments via Gemini API (max concurrency: {concurrency})..."
+    )
+    results = await analyze_comments_concurrently(
+        model,
+        [comment["comment_text"] for comment in pending_comments],
+        concurrency,
+        limiter,
+        cache,
+        batch_size,
+    )
+
+    for comment, analysis_result in zip(pending_comments, results):
+        if isinstance(analysis_result, Exception):
+            logging.error(
+                f"Unexpected error analyzing comment ID {comment.get('comment_id')}: {analysis_result}"
+            )
+            analysis_result = None
+
+        if analysis_result:
+            comment["analysis"] = analysis_result
+            stats["processed"] += 1
+        else:
+            comment["analysis"] = {"error": "Failed to analyze after retries"}
+            stats["failed"] += 1
+            logging.error(f"Failed to analyze comment ID: {comment.get('comment_id')}")
+
+    if semantic_cache:
+        new_entries = [
+            (embedding, comment["analysis"])
+            for comment, embedding in zip(pending_comments, pending_embeddings)
+            if is_cacheable_analysis(comment["analysis"])
+        ]
+        semantic_cache.add(
+            [embedding for embedding, _ in new_entries],
+            [analysis for _, analysis in new_entries],
+        )
+
+    for comment_text, (first, *duplicates) in comments_by_text.items():
+        seen_analyses[text_digest(comment_text)] = first["analysis"]
+        for duplicate in duplicates:
+            duplicate["analysis"] = dict(first["analysis"])
+        if "error" in first["analysis"]:
+            stats["failed"] += len(duplicates)
+
+
+async def analyze_in_chunks(
+    comments,
+    checkpoint_file,
+    model,
+    profanity_automaton,
+    cache,
+    semantic_cache,
+    local_classifier,
+    concurrency,
+    qps,
+    batch_size,
+    stats,
+):
+    """Analyzes a stream of comments chunk by chunk, checkpointing each chunk.
+
+    Comments arrive as (input position, input record hash, comment) tuples.
+    Caches are flushed every CACHE_FLUSH_INTERVAL chunks and on exit; an
+    analysis lost from the cache by a crash is still kept in the checkpoint.
+
+    Runs on a single event loop so the Gemini client's channel is reused
+    across chunks. A single rate limiter is shared by every request.
+    """
+    # AsyncLimiter cannot grant a request with a capacity below 1, so rates
+    # under 1 QPS are expressed as one request per 1 / qps seconds.
+    if qps >= 1:
+        limiter = AsyncLimiter(qps, time_period=1)
+    else:
+        limiter = AsyncLimiter(1, time_period=1 / qps)
+    seen_analyses = {}
+
+    def cache_sizes():
+        return len(cache), len(semantic_cache.analyses) if semantic_cache else 0
+
+    saved_sizes = cache_sizes()
+
+    def flush_caches():
+        nonlocal saved_sizes
+        if cache_sizes() == saved_sizes:
+            return
+        save_cache(CACHE_FILE, cache)
+        if semantic_cache:
+            semantic_cache.save()
+        saved_sizes = cache_sizes()
+
+    try:
+        for chunk_number in itertools.count(1):
+            chunk = list(itertools.islice(comments, CHECKPOINT_INTERVAL))
+            if not chunk:
+                break
+            await analyze_comments(
+                [comment for _, _, comment in chunk],
+                model,
+                profanity_automaton,
+                cache,
+                semantic_cache,
+                local_classifier,
+                concurrency,
+                limiter,
+                batch_size,
+                stats,
+                seen_analyses,
+            )
+            append_checkpoint(checkpoint_file, chunk)
+            if chunk_number % CACHE_FLUSH_INTERVAL == 0:
+                flush_caches()
+    finally:
+        flush_caches()
+
+
+def positive_int(value):
+    """Parses a command-line argument that must be a positive integer."""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value!r}")
+    return number
 
 
 def main():
@@ -249,6 +1084,29 @@ def main():
         default=INPUT_FILE,
         help=f"Path to the input JSON file containing comments (default: {INPUT_FILE})",
     )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=positive_int,
+        default=MAX_CONCURRENCY,
+        help=f"Maximum number of concurrent Gemini API requests (default: {MAX_CONCURRENCY})",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        type=positive_int,
+        default=BATCH_SIZE,
+        help=f"Number of comments analyzed per Gemini API request (default: {BATCH_SIZE})",
+    )
+    parser.add_argument(
+        "--local-model",
+        help="Directory with an ONNX toxicity model used to skip the API for clearly benign comments (requires onnxruntime and tokenizers)",
+    )
+    parser.add_argument(
+        "--semantic-cache",
+        action="store_true",
+        help="Reuse analyses of semantically similar comments (requires sentence-transformers)",
+    )
     args = parser.parse_args()
     input_filepath = args.input
 
@@ -259,81 +1117,98 @@ def main():
     genai_client = configure_genai()
     if not genai_client:
         return
+    qps = parse_qps(GEMINI_QPS)
+    model = genai_client.GenerativeModel(
+        MODEL_NAME, system_instruction=SYSTEM_INSTRUCTION
+    )
 
     comments = load_comments(input_filepath)
     if comments is None:
         return
 
+    try:
+        sample_comments = list(itertools.islice(comments, 3))
+    except ijson.JSONError as e:
+        logging.error(f"Error: Could not decode JSON from {input_filepath}: {e}")
+        return
+    comments = itertools.chain(sample_comments, comments)
+
     print(f"\n--- Initial Summary ---")
-    print(f"Total comments loaded: {len(comments)}")
-    if comments:
+    if sample_comments:
         print("Sample comments:")
-        for i, comment in enumerate(comments[:3]):
+        for i, comment in enumerate(sample_comments):
             print(
-                f"  {i+1}. ID: {comment['comment_id']}, User: {comment['username']}, Text: {comment['comment_text'][:60]}..."
+                f"  {i+1}. ID: {comment.get('comment_id')}, User: {comment['username']}, Text: {comment['comment_text'][:60]}..."
             )
     print("-" * 20 + "\n")
 
-    profanity.load_censor_words()
+    cache = load_cache(CACHE_FILE)
+    semantic_cache = SemanticCache(SEMANTIC_CACHE_FILE) if args.semantic_cache else None
+    local_classifier = (
+        LocalToxicityClassifier(args.local_model) if args.local_model else None
+    )
+
+    profanity_automaton = build_profanity_automaton()
     logging.info("Initialized profanity checker.")
 
     logging.info("Starting comment analysis (with profanity pre-check)...")
-    analyzed_comments = []
-    processed_count = 0
-    failed_count = 0
-    pre_filtered_count = 0
-
-    for comment in comments:
-        comment_text = comment.get("comment_text")
-        if not comment_text:
-            logging.warning(
-                f"Skipping comment ID {comment.get('comment_id')} due to missing 'comment_text'."
-            )
-            comment["analysis"] = {"error": "Missing comment text"}
-            analyzed_comments.append(comment)
-            failed_count += 1
-            continue
-
-        if profanity.contains_profanity(comment_text):
-            logging.info(
-                f"Profanity detected in comment ID: {comment.get('comment_id')}. Skipping API call."
-            )
-            analysis_result = {
-                "is_offensive": True,
-                "offense_type": "profanity",
-                "explanation": "Detected by profanity pre-filter.",
-                "severity": 3,
-            }
-            pre_filtered_count += 1
-        else:
+    checkpoint_state = load_checkpoint_state(CHECKPOINT_FILE)
+    total_count = 0
+    resumed_count = 0
 
-            logging.info(
-                f"Analyzing comment ID: {comment.get('comment_id')} via Gemini API..."
-            )
-            analysis_result = analyze_comment_with_retry(
-                genai_client, MODEL_NAME, comment_text
-            )
-
-            if analysis_result:
-                processed_count += 1
+    def remaining_comments():
+        nonlocal total_count, resumed_count
+        for index, comment in enumerate(comments):
+            total_count += 1
+            comment_hash = record_hash(comment)
+            if is_checkpointed(index, comment_hash, checkpoint_state):
+                resumed_count += 1
             else:
-                comment["analysis"] = {"error": "Failed to analyze after retries"}
-                failed_count += 1
-                logging.error(
-                    f"Failed to analyze comment ID: {comment.get('comment_id')}"
-                )
-
-        if analysis_result:
-            comment["analysis"] = analysis_result
+                yield index, comment_hash, comment
 
-        analyzed_comments.append(comment)
+    stats = Counter()
+    try:
+        with open_checkpoint(CHECKPOINT_FILE) as checkpoint_file:
+            asyncio.run(
+                analyze_in_chunks(
+                    remaining_comments(),
+                    checkpoint_file,
+                    model,
+                    profanity_automaton,
+                    cache,
+                    semantic_cache,
+                    local_classifier,
+                    args.concurrency,
+                    qps,
+                    args.batch_size,
+                    stats,
+                )
+            )
+    except ijson.JSONError as e:
+        # Saving now would write a truncated output and report; the comments
+        # analyzed so far stay in the checkpoint for the next run.
+        logging.error(
+            f"Error: Could not decode JSON from {input_filepath} after {total_count} comments: {e}"
+        )
+        return
 
+    logging.info(f"Total comments read: {total_count}")
+    if resumed_count:
+        logging.info(
+            f"Resumed: {resumed_count} comments were already analyzed in {CHECKPOINT_FILE}"
+        )
     logging.info(
-        f"Analysis complete. Pre-filtered (profanity): {pre_filtered_count}, Processed via API: {processed_count}, Failed: {failed_count}"
+        f"Analysis complete. Pre-filtered (profanity): {stats['pre_filtered']}, Pre-filtered (local model): {stats['local_filtered']}, Cache hits: {stats['cache_hits']}, Semantic cache hits: {stats['semantic_hits']}, Duplicates: {stats['duplicates']}, Processed via API: {stats['processed']}, Failed: {stats['failed']}"
     )
 
+    checkpoint = load_checkpoint(CHECKPOINT_FILE)
+    analyzed_comments = [
+        checkpoint[index] for index in range(total_count) if index in checkpoint
+    ]
     save_analyzed_comments(OUTPUT_FILE, analyzed_comments)
-    generate_report(analyzed_comments)
+    chart_thread = generate_report(analyzed_comments)
+    if chart_thread:
+        chart_thread.join()
 
     logging.info("Comment analysis process finished.")
 